@@ -1,14 +1,23 @@
+import io
 import os
 import re
 import time
+import pickle
+import hashlib
 import asyncio
 import logging
 from pathlib import Path
 from dotenv import load_dotenv
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import diskcache
+import orjson
+from html.parser import HTMLParser
+from pybloom_live import ScalableBloomFilter
+from aiolimiter import AsyncLimiter
 from telegram import Bot, Update
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
 
 # --- Logging ---
 logging.basicConfig(
@@ -26,22 +35,92 @@ INTERVAL = int(os.getenv('CHECK_INTERVAL', '300'))
 # --- File paths ---
 BASE_DIR = Path(__file__).parent
 KNOWN_OFFERS_PATH = BASE_DIR / 'known_offers.txt'
+KNOWN_OFFERS_LOG_PATH = BASE_DIR / 'known_offers.log'
+KNOWN_OFFERS_BLOOM_PATH = BASE_DIR / 'known_offers.bloom'
 SUBSCRIBERS_PATH = BASE_DIR / 'subscribers.txt'
 
+# Parsed detail pages rarely change once published; cache them on disk
+# so a new /start does not refetch every current listing.
+DETAILS_CACHE = diskcache.Cache(str(BASE_DIR / 'details_cache'))
+DETAILS_CACHE_TTL = 86400
+
 # --- Telegram Bot ---
-bot = Bot(token=BOT_TOKEN)
+# One pooled HTTP/2 client lets concurrent sends share a single
+# connection to api.telegram.org instead of one socket per message.
+bot = Bot(
+    token=BOT_TOKEN,
+    request=HTTPXRequest(connection_pool_size=32, http_version='2')
+)
+
+# --- HTTP client (shared pool; HTTP/2 multiplexes detail fetches) ---
+CLIENT = httpx.AsyncClient(
+    http2=True,
+    headers={'User-Agent': 'Mozilla/5.0'},
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=8)
+)
+FETCH_SEMAPHORE = asyncio.Semaphore(5)
 
 # --- Cache Management ---
 def load_known_offers():
-    if not KNOWN_OFFERS_PATH.exists():
-        return set()
-    with open(KNOWN_OFFERS_PATH, 'r') as f:
-        return set(line.strip() for line in f if line.strip())
+    offers = set()
+    if KNOWN_OFFERS_PATH.exists():
+        raw = KNOWN_OFFERS_PATH.read_bytes()
+        if raw:
+            try:
+                offers.update(orjson.loads(raw))
+            except orjson.JSONDecodeError:
+                # Legacy one-ID-per-line format
+                offers.update(
+                    line.strip() for line in raw.decode().splitlines() if line.strip()
+                )
+    if KNOWN_OFFERS_LOG_PATH.exists():
+        with open(KNOWN_OFFERS_LOG_PATH, 'r') as f:
+            offers.update(line.strip() for line in f if line.strip())
+    return offers
 
 def save_known_offers(offers):
-    with open(KNOWN_OFFERS_PATH, 'w') as f:
-        for offer_id in sorted(offers):
-            f.write(f"{offer_id}\n")
+    tmp = KNOWN_OFFERS_PATH.with_suffix('.tmp')
+    tmp.write_bytes(orjson.dumps(sorted(offers)))
+    os.replace(tmp, KNOWN_OFFERS_PATH)
+    KNOWN_OFFERS_LOG_PATH.unlink(missing_ok=True)
+
+# A scalable Bloom filter keeps the membership test at ~10 bits per ID
+# instead of a full in-memory set. A false positive only suppresses a
+# notification that was almost certainly already sent.
+def load_bloom():
+    if KNOWN_OFFERS_BLOOM_PATH.exists():
+        with open(KNOWN_OFFERS_BLOOM_PATH, 'rb') as f:
+            return pickle.load(f)
+    bloom = ScalableBloomFilter(
+        mode=ScalableBloomFilter.LARGE_SET_GROWTH,
+        initial_capacity=10000,
+        error_rate=1e-6
+    )
+    for offer_id in load_known_offers():
+        bloom.add(offer_id)
+    return bloom
+
+def save_bloom(bloom):
+    tmp = KNOWN_OFFERS_BLOOM_PATH.with_suffix('.bloom.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump(bloom, f)
+    os.replace(tmp, KNOWN_OFFERS_BLOOM_PATH)
+
+COMPACT_EVERY = 1000
+_appends_since_compact = 0
+
+def append_known_offers(new_ids):
+    global _appends_since_compact
+    new_ids = list(new_ids)
+    if not new_ids:
+        return
+    with open(KNOWN_OFFERS_LOG_PATH, 'a') as f:
+        f.write('\n'.join(new_ids) + '\n')
+    _appends_since_compact += len(new_ids)
+    if _appends_since_compact >= COMPACT_EVERY:
+        save_known_offers(load_known_offers())
+        _appends_since_compact = 0
 
 # --- Subscription ---
 def load_subscribers():
@@ -50,73 +129,196 @@ def load_subscribers():
     with open(SUBSCRIBERS_PATH, 'r') as f:
         return set(line.strip() for line in f if line.strip())
 
-def save_subscribers(subscribers):
-    with open(SUBSCRIBERS_PATH, 'w') as f:
-        for chat_id in sorted(subscribers):
-            f.write(f"{chat_id}\n")
+_SUBSCRIBERS: set | None = None
+
+def get_subscribers():
+    global _SUBSCRIBERS
+    if _SUBSCRIBERS is None:
+        _SUBSCRIBERS = load_subscribers()
+    return _SUBSCRIBERS
+
+def add_subscriber(chat_id):
+    get_subscribers().add(chat_id)
+    with open(SUBSCRIBERS_PATH, 'a') as f:
+        f.write(f"{chat_id}\n")
 
 # --- Parsing ---
-def fetch_offers():
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    response = requests.get(SAGA_URL, headers=headers, timeout=10)
+# The listing page only yields hrefs of a fixed shape; a regex over the
+# raw bytes is far cheaper than building a DOM for the whole page.
+_HREF_RE = re.compile(rb'href="(/immobiliensuche/immo-detail/[^"]+/([^/"]+)/)"')
+_WS_RE = re.compile(r'\s+')
+
+# Conditional-GET state: skip downloading and reparsing unchanged pages.
+_LAST_ETAG = None
+_LAST_MODIFIED = None
+_LAST_HASH = None
+_LAST_OFFERS = {}
+
+async def fetch_offers():
+    global _LAST_ETAG, _LAST_MODIFIED, _LAST_HASH, _LAST_OFFERS
+    headers = {}
+    if _LAST_ETAG:
+        headers['If-None-Match'] = _LAST_ETAG
+    if _LAST_MODIFIED:
+        headers['If-Modified-Since'] = _LAST_MODIFIED
+
+    response = await CLIENT.get(SAGA_URL, headers=headers)
+    if response.status_code == 304:
+        return _LAST_OFFERS
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
+    _LAST_ETAG = response.headers.get('ETag')
+    _LAST_MODIFIED = response.headers.get('Last-Modified')
+    body = response.content
+
+    # Even without ETag support, most polls return byte-identical HTML;
+    # hashing is far cheaper than parsing it again.
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+    if digest == _LAST_HASH:
+        return _LAST_OFFERS
+    _LAST_HASH = digest
 
     offers = {}
-    for listing in soup.select('a[href*="/immobiliensuche/immo-detail/"]'):
-        href = listing['href']
-        parts = href.strip('/').split('/')
-        offer_id = parts[-2]
-        full_url = f"https://www.saga.hamburg{href}"
-        title = listing.get_text(strip=True) or 'Neue Anzeige'
+    for m in _HREF_RE.finditer(body):
+        href = m.group(1).decode()
+        offer_id = m.group(2).decode()
         offers[offer_id] = {
-            'url': full_url,
-            'title': title,
+            'url': f"https://www.saga.hamburg{href}",
+            'title': 'Neue Anzeige',
         }
+    _LAST_OFFERS = offers
     return offers
 
-def parse_offer_details(offer):
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    response = requests.get(offer['url'], headers=headers, timeout=10)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
-    data = {}
-
-    for dl in soup.find_all('dl'):
-        for dt, dd in zip(dl.find_all('dt'), dl.find_all('dd')):
-            k = dt.get_text(strip=True)
-            v = dd.get_text(strip=True)
-            if v:
-                data[k] = v
-
-    for table in soup.find_all('table'):
-        for row in table.find_all('tr'):
-            cols = row.find_all(['th', 'td'])
-            if len(cols) == 2:
-                k = cols[0].get_text(strip=True)
-                v = cols[1].get_text(strip=True)
+class _DetailParser(HTMLParser):
+    """Single-pass stream parser for the offer detail page.
+
+    Collects dt/dd pairs and two-column table rows without building a
+    DOM. Sets ``done`` once every key the message needs has been seen,
+    so feeding can stop early.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.data = {}
+        self.done = False
+        self._mode = None       # 'dt', 'dd' or 'cell' while inside one
+        self._buf = []
+        self._key = None        # pending dt text waiting for its dd
+        self._cells = None      # collected cell texts of the current tr
+
+    def _text(self):
+        return _WS_RE.sub(' ', ''.join(self._buf)).strip()
+
+    def _check_done(self):
+        if WANTED_KEYS <= self.data.keys():
+            self.done = True
+
+    # HTML allows omitting </dt>, </dd>, </th>, </td> and </tr>, so a
+    # new start tag has to close whatever is still open.
+    def _close_pending(self):
+        if self._mode == 'dt':
+            self._key = self._text()
+        elif self._mode == 'dd':
+            if self._key in WANTED_KEYS:
+                v = self._text()
                 if v:
-                    data[k] = v
-
-    desc = soup.select_one('#text-description, .description')
-    if desc:
-        text = desc.get_text(separator=' ', strip=True)
-        if text:
-            data['Beschreibung'] = text
+                    self.data[self._key] = v
+            self._key = None
+            self._check_done()
+        elif self._mode == 'cell' and self._cells is not None:
+            self._cells.append(self._text())
+        self._mode = None
+        self._buf = []
+
+    def _close_row(self):
+        self._close_pending()
+        if self._cells is not None:
+            if len(self._cells) == 2 and self._cells[0] in WANTED_KEYS and self._cells[1]:
+                self.data[self._cells[0]] = self._cells[1]
+            self._cells = None
+            self._check_done()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'dt':
+            self._close_pending()
+            self._mode = 'dt'
+        elif tag == 'dd':
+            self._close_pending()
+            self._mode = 'dd'
+        elif tag == 'tr':
+            self._close_row()
+            self._cells = []
+        elif tag in ('th', 'td'):
+            self._close_pending()
+            if self._cells is not None:
+                self._mode = 'cell'
+        elif tag in ('dl', 'table'):
+            self._close_row()
+
+    def handle_startendtag(self, tag, attrs):
+        pass
+
+    def handle_endtag(self, tag):
+        if tag in ('dt', 'dd', 'th', 'td'):
+            self._close_pending()
+        elif tag in ('tr', 'dl', 'table'):
+            self._close_row()
+
+    def handle_data(self, data):
+        if self._mode is not None:
+            self._buf.append(data)
+
+_FEED_CHUNK = 65536
+
+async def parse_offer_details(offer):
+    offer_id = offer['url'].split('/')[-2]
+    cached = DETAILS_CACHE.get(offer_id)
+    if cached is not None:
+        return cached
+
+    async with FETCH_SEMAPHORE:
+        response = await CLIENT.get(offer['url'])
+    response.raise_for_status()
 
+    parser = _DetailParser()
+    html = response.text
+    for start in range(0, len(html), _FEED_CHUNK):
+        parser.feed(html[start:start + _FEED_CHUNK])
+        if parser.done:
+            break
+    parser.close()
+    data = parser.data
+
+    # An empty parse means a failure or markup change; don't pin it in
+    # the cache for a day.
+    if data:
+        DETAILS_CACHE.set(offer_id, data, expire=DETAILS_CACHE_TTL)
     return data
 
 # --- Format message ---
+# (detail key, emoji, message label, suffix) in display order
+MESSAGE_FIELDS = (
+    ('Objektnummer', '🆔', 'Objektnummer', ''),
+    ('Netto-Kaltmiete', '💵', 'Kaltmiete', ' €'),
+    ('Betriebskosten', '💡', 'Betriebskosten', ' €'),
+    ('Heizkosten', '🔥', 'Heizkosten', ' €'),
+    ('Gesamtmiete', '💰', 'Gesamtmiete', ' €'),
+    ('Wohnfläche ca.', '📐', 'Wohnfläche', ' m²'),
+    ('Zimmer', '🛏️', 'Zimmer', ''),
+    ('Etage', '🏢', 'Etage', ''),
+    ('Verfügbar ab', '📅', 'Verfügbar ab', ''),
+)
+
+# Everything build_message can render; lets the stream parser stop early.
+WANTED_KEYS = frozenset(key for key, _, _, _ in MESSAGE_FIELDS) | {
+    'Energieeffizienzklasse',
+}
+
 def build_message(data, details):
     title = data.get('title', 'Neue Anzeige')
     url = data.get('url')
     offer_id = url.split('/')[-2]
     immomio_link = f"https://tenant.immomio.com/de/apply/{offer_id}"
 
-    def line(emoji, label, value, suffix=''):
-        value = value.replace("€", "").replace("m²", "").strip()
-        return f"{emoji} *{label}:* {value}{suffix}".strip()
-
     # Energy class colors
     energy_emoji = {
         "A+": "🟢", "A": "🟢", "B": "🟢",
@@ -126,81 +328,95 @@ def build_message(data, details):
     energy_class = details.get("Energieeffizienzklasse", "").strip()
     energy_icon = energy_emoji.get(energy_class.upper(), "⚡️")
 
-    lines = [f"🏠 *{title}*"]
-
-    if details.get("Objektnummer"):
-        lines.append(line("🆔", "Objektnummer", details["Objektnummer"]))
-    if details.get("Netto-Kaltmiete"):
-        lines.append(line("💵", "Kaltmiete", details["Netto-Kaltmiete"], " €"))
-    if details.get("Betriebskosten"):
-        lines.append(line("💡", "Betriebskosten", details["Betriebskosten"], " €"))
-    if details.get("Heizkosten"):
-        lines.append(line("🔥", "Heizkosten", details["Heizkosten"], " €"))
-    if details.get("Gesamtmiete"):
-        lines.append(line("💰", "Gesamtmiete", details["Gesamtmiete"], " €"))
-    if details.get("Wohnfläche ca."):
-        lines.append(line("📐", "Wohnfläche", details["Wohnfläche ca."], " m²"))
-    if details.get("Zimmer"):
-        lines.append(line("🛏️", "Zimmer", details["Zimmer"]))
-    if details.get("Etage"):
-        lines.append(line("🏢", "Etage", details["Etage"]))
-    if details.get("Verfügbar ab"):
-        lines.append(line("📅", "Verfügbar ab", details["Verfügbar ab"]))
+    buf = io.StringIO()
+    buf.write(f"🏠 *{title}*")
+    for key, emoji, label, suffix in MESSAGE_FIELDS:
+        value = details.get(key)
+        if value:
+            value = _WS_RE.sub(' ', value.replace("€", "").replace("m²", "")).strip()
+            buf.write(f"\n{emoji} *{label}:* {value}{suffix}")
     if energy_class:
-        lines.append(f"{energy_icon} *Energieklasse:* {energy_class}")
+        buf.write(f"\n{energy_icon} *Energieklasse:* {energy_class}")
 
-    lines.append("")
-    lines.append(f"🔗 [Anzeigen-Link]({url})")
-    lines.append(f"📬 [Jetzt bewerben]({immomio_link})")
+    buf.write(f"\n\n🔗 [Anzeigen-Link]({url})")
+    buf.write(f"\n📬 [Jetzt bewerben]({immomio_link})")
 
-    return '\n'.join(lines)
+    return buf.getvalue()
 
 # --- Notifier ---
+# Telegram allows ~30 messages/s across all chats; stay just under it.
+SEND_LIMITER = AsyncLimiter(25, 1)
+
+async def send_to_subscriber(chat_id, msg):
+    for attempt in range(2):
+        try:
+            async with SEND_LIMITER:
+                await bot.send_message(
+                    chat_id=int(chat_id),
+                    text=msg,
+                    parse_mode='Markdown',
+                    disable_web_page_preview=True
+                )
+            return
+        except RetryAfter as e:
+            logger.warning(f"Rate limited, sleeping {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Failed to send to {chat_id}: {e}")
+            return
+    logger.error(f"Failed to send to {chat_id}: still rate limited")
+
 async def notify_new_offers(new_offers):
-    subscribers = load_subscribers()
+    subscribers = get_subscribers()
     if not subscribers:
         logger.info("No subscribers to notify.")
         return
 
-    for offer_id, offer in new_offers.items():
-        try:
-            details = parse_offer_details(offer)
-            msg = build_message(offer, details)
-            for chat_id in subscribers:
-                try:
-                    await bot.send_message(
-                        chat_id=int(chat_id),
-                        text=msg,
-                        parse_mode='Markdown',
-                        disable_web_page_preview=True
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send to {chat_id}: {e}")
-            logger.info(f"Sent offer {offer_id}")
-        except Exception as e:
-            logger.error(f"Error parsing {offer_id}: {e}")
+    details_list = await asyncio.gather(
+        *(parse_offer_details(offer) for offer in new_offers.values()),
+        return_exceptions=True
+    )
+
+    for (offer_id, offer), details in zip(new_offers.items(), details_list):
+        if isinstance(details, Exception):
+            logger.error(f"Error parsing {offer_id}: {details}")
+            continue
+        msg = build_message(offer, details)
+        await asyncio.gather(
+            *(send_to_subscriber(chat_id, msg) for chat_id in subscribers)
+        )
+        logger.info(f"Sent offer {offer_id}")
 
 # --- Background task ---
 async def check_and_notify_loop():
-    if KNOWN_OFFERS_PATH.exists():
-        age = time.time() - KNOWN_OFFERS_PATH.stat().st_mtime
-        if age > 7 * 86400:
-            KNOWN_OFFERS_PATH.unlink()
-            logger.info("Cache too old — cleared known_offers.txt")
-
-    seen = load_known_offers()
+    # The snapshot is only rewritten at compaction, so judge staleness by
+    # the newest of snapshot, delta log and bloom filter.
+    mtimes = [
+        path.stat().st_mtime
+        for path in (KNOWN_OFFERS_PATH, KNOWN_OFFERS_LOG_PATH, KNOWN_OFFERS_BLOOM_PATH)
+        if path.exists()
+    ]
+    if mtimes and time.time() - max(mtimes) > 7 * 86400:
+        KNOWN_OFFERS_PATH.unlink(missing_ok=True)
+        KNOWN_OFFERS_LOG_PATH.unlink(missing_ok=True)
+        KNOWN_OFFERS_BLOOM_PATH.unlink(missing_ok=True)
+        logger.info("Cache too old — cleared known offers")
+
+    seen = load_bloom()
     logger.info(f"Loaded {len(seen)} known offers.")
 
     while True:
         try:
-            offers = fetch_offers()
+            offers = await fetch_offers()
             logger.info(f"Found {len(offers)} offers on search page.")
             new = {oid: offer for oid, offer in offers.items() if oid not in seen}
             if new:
                 logger.info(f"New offers: {list(new.keys())}")
                 await notify_new_offers(new)
-                seen.update(new)
-                save_known_offers(seen)
+                for oid in new:
+                    seen.add(oid)
+                append_known_offers(new)
+                save_bloom(seen)
             else:
                 logger.info("No new offers.")
         except Exception as e:
@@ -210,18 +426,17 @@ async def check_and_notify_loop():
 # --- Command handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
-    subscribers = load_subscribers()
+    subscribers = get_subscribers()
 
     if chat_id not in subscribers:
-        subscribers.add(chat_id)
-        save_subscribers(subscribers)
+        add_subscriber(chat_id)
         logger.info(f"New subscriber added: {chat_id}")
         await update.message.reply_text("✅ You are now subscribed to apartment updates.")
     else:
         await update.message.reply_text("ℹ️ You are already subscribed.")
 
     # Send current offers
-    offers = fetch_offers()
+    offers = await fetch_offers()
     logger.info(f"Sending {len(offers)} current offers to chat {chat_id}")
 
     if not offers:
@@ -229,14 +444,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     for offer_id, offer_data in offers.items():
-        details = parse_offer_details(offer_data)
-        message = build_message(offer_data, details)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=message,
-            parse_mode='Markdown',
-            disable_web_page_preview=True
-        )
+        details = await parse_offer_details(offer_data)
+        await send_to_subscriber(chat_id, build_message(offer_data, details))
 
 # --- Entry point ---
 def run_bot():
@@ -246,7 +455,11 @@ def run_bot():
     async def startup(app: Application):
         asyncio.create_task(check_and_notify_loop())
 
+    async def shutdown(app: Application):
+        await CLIENT.aclose()
+
     application.post_init = startup
+    application.post_shutdown = shutdown
     application.run_polling()
 
 if __name__ == '__main__':